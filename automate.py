@@ -1,12 +1,18 @@
-from download_hcp import do_subject
 import multiprocessing as mp 
-from rpy2.robjects.packages import importr
 import zipshelve
+import connectivity
+import lease
+import time
 from pickle import HIGHEST_PROTOCOL
 from datetime import datetime
 
 batch_size = 4
 
+# Also derive functional connectivity into a '_fc' shelf next to each batch,
+# fc_options are passed on to connectivity.subject_connectivity()
+derive_fc = True
+fc_options = dict(concatenate=False, fisher=False)
+
 
 def batches(iterable, n=1):
     l = len(iterable)
@@ -14,10 +20,10 @@ def batches(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
-def main():
-
-    # Read in subject list as a list
+def setup():
+    """ Make sure R::cifti is installed and read in the subject list as a list. """
 
+    from rpy2.robjects.packages import importr
     from rpy2.rinterface import RRuntimeError as RRE
 
     try:
@@ -30,7 +36,14 @@ def main():
         subject_ids = stream.readlines()
 
     # Strip newline characters
-    subject_ids = [idx.strip() for idx in subject_ids]
+    return [idx.strip() for idx in subject_ids]
+
+
+def main():
+
+    from download_hcp import do_subject
+
+    subject_ids = setup()
     fin = 'HCP_1200/hcp_data_'
 
     # Download and process. `procs` is # of processors
@@ -40,7 +53,7 @@ def main():
     for i, batch in enumerate(batches(subject_ids, batch_size)):
         
         with mp.Pool(procs) as pool:
-            result = zip(batch, pool.map(do_subject, batch))
+            result = list(zip(batch, pool.map(do_subject, batch)))
 
         print('Shelving batch: \t', i)
         fname = fin + str(i) + '.gdb'
@@ -49,6 +62,12 @@ def main():
             for key, value in result:
                 shelf[key] = value
 
+        if derive_fc:
+            with zipshelve.open(fin + str(i) + '_fc.gdb', protocol=HIGHEST_PROTOCOL) as shelf:
+                for key, value in result:
+                    if isinstance(value, dict):
+                        shelf[key] = connectivity.subject_connectivity(value, **fc_options)
+
     print(datetime.now())
 
     # # Serial instead of parallel?
@@ -62,5 +81,104 @@ def main():
     #         shelf[key] = value
 
 
+def worker(lease_dir='HCP_1200/leases', fin='HCP_1200/hcp_data_', subject_ids=None, process=None,
+           ttl=lease.ttl, max_attempts=lease.attempts):
+    """ Process subjects one at a time, claiming them through lease files in lease_dir.
+
+    Any number of workers, on one or several hosts, can be started against the same
+    lease_dir and subjectlist.txt on a shared filesystem. Each writes to its own shelf
+    shard named after the host and process id. A worker keeps polling until every
+    subject is done, so subjects held by workers that died are picked up once their
+    lease expires. A subject whose processing raises is retried, by this or another
+    worker, and marked failed and skipped after lease.attempts tries.
+
+    Arguments:
+        lease_dir - Shared directory for lease files
+        fin - Prefix of the shelf shards
+        subject_ids - The subjects to process, defaults to subjectlist.txt (via setup())
+        process - The per-subject function, defaults to do_subject()
+        ttl - Seconds without a heartbeat after which a lease counts as abandoned
+        max_attempts - Failed tries after which a subject is given up on
+    """
+
+    if subject_ids is None:
+        subject_ids = setup()
+    if process is None:
+        from download_hcp import do_subject as process
+
+    owner = lease.worker_id()
+    fname = fin + owner + '.gdb'
+    print(datetime.now(), '\tWorker: ', owner)
+
+    # Subjects that failed here are tried last, so other work goes first
+    retry = list()
+
+    while True:
+        order = [sid for sid in subject_ids if sid not in retry] + retry
+        claimed = lease.claim_next(lease_dir, order, owner, ttl)
+
+        if claimed is None:
+            if not lease.remaining(lease_dir, subject_ids):
+                break
+            # Everything left is held by other workers, wait in case one of them dies
+            time.sleep(ttl / 3.0)
+            continue
+
+        try:
+            with claimed:
+                value = process(claimed.sid)
+        except Exception as e:
+            print('Failed subject: \t', claimed.sid, '\t', repr(e))
+            if not claimed.fail(e, max_attempts):
+                print('Lost lease, dropping: \t', claimed.sid)
+            elif claimed.sid not in retry:
+                retry.append(claimed.sid)
+            continue
+        except BaseException:
+            claimed.release()
+            raise
+
+        # The lease may have expired and been reclaimed by another worker while we were busy
+        if claimed.lost or not claimed.heartbeat():
+            print('Lost lease, dropping: \t', claimed.sid)
+            continue
+
+        try:
+            with zipshelve.open(fname, protocol=HIGHEST_PROTOCOL) as shelf:
+                shelf[claimed.sid] = value
+
+            if derive_fc and isinstance(value, dict):
+                with zipshelve.open(fin + owner + '_fc.gdb', protocol=HIGHEST_PROTOCOL) as shelf:
+                    shelf[claimed.sid] = connectivity.subject_connectivity(value, **fc_options)
+        except BaseException:
+            claimed.release()
+            raise
+
+        claimed.done()
+
+    print(datetime.now())
+
+
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', action='store_true',
+                        help='claim subjects through lease files instead of using a local pool')
+    parser.add_argument('--lease-dir', default='HCP_1200/leases',
+                        help='shared directory for lease files (with --worker)')
+    parser.add_argument('--ttl', type=float, default=lease.ttl,
+                        help='seconds without a heartbeat after which a lease is reclaimed (with --worker)')
+    parser.add_argument('--no-fc', action='store_true', help='do not derive functional connectivity')
+    parser.add_argument('--concatenate', action='store_true',
+                        help='derive one connectivity matrix over all runs concatenated in time')
+    parser.add_argument('--fisher', action='store_true', help='store Fisher z-transformed correlations')
+    args = parser.parse_args()
+
+    derive_fc = not args.no_fc
+    fc_options.update(concatenate=args.concatenate, fisher=args.fisher)
+
+    if args.worker:
+        worker(args.lease_dir, ttl=args.ttl)
+    else:
+        main()
@@ -0,0 +1,224 @@
+import os
+import hashlib
+import numpy as np
+import zipshelve
+from pickle import HIGHEST_PROTOCOL
+
+# Derived-feature stage: ROI x ROI functional connectivity computed from the
+# per-ROI timeseries dictionaries that process_ptseries() produces. Results
+# are stored as float32 upper triangles (diagonal excluded) together with a
+# hash of the timeseries they were computed from, so a stored record can be
+# reused as long as the underlying data and options are unchanged.
+
+
+def run_names(subject):
+    """ Pick out the runs in a subject's shelved dictionary.
+
+    Arguments:
+        subject - A dictionary as returned by clean_subject()
+
+    Returns:
+        A sorted list of run names (e.g. 'REST1_LR') whose values are ROI/timeseries dictionaries
+    """
+    return sorted(key for key, value in subject.items() if isinstance(value, dict))
+
+
+def stack_runs(subject, runs=None):
+    """ Stack the per-ROI timeseries of each run into a ROI x time matrix.
+
+    Arguments:
+        subject - A dictionary as returned by clean_subject()
+        runs - The runs to stack, defaults to all runs in subject
+
+    Returns:
+        A tuple of ROI names, run names and a list of ROI x time float64 arrays (one per run)
+    """
+    runs = run_names(subject) if runs is None else list(runs)
+    if not runs:
+        raise KeyError('No timeseries runs found in subject')
+
+    # All runs share one parcellation, use the ROI order of the first
+    rois = list(subject[runs[0]].keys())
+    mats = [np.asarray([subject[run][roi] for roi in rois], dtype=np.float64) for run in runs]
+
+    return rois, runs, mats
+
+
+def zscore(mat):
+    """ Z-score each row (ROI) of a ... x ROI x time array along the time axis.
+    Rows with zero variance are returned as zeros rather than NaNs.
+    """
+    centered = mat - mat.mean(axis=-1, keepdims=True)
+    std = centered.std(axis=-1, keepdims=True)
+    std[std == 0] = 1.0
+    return centered / std
+
+
+def content_hash(rois, runs, mats, **options):
+    """ Hash the timeseries and options a connectivity record is computed from.
+
+    Returns:
+        A hex digest that changes whenever the data, ROI/run order or options change
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((rois, runs, sorted(options.items()))).encode('utf-8'))
+    for mat in mats:
+        digest.update(repr(mat.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(mat).tobytes())
+    return digest.hexdigest()
+
+
+def source_hash(raw, **options):
+    """ Hash the raw (compressed, pickled) bytes a subject is stored as in a shelf, plus options.
+
+    Unlike content_hash() this needs neither decompressing nor unpickling the subject, so
+    derive_shelf() can skip up-to-date subjects without loading them.
+    """
+    digest = hashlib.sha1(repr(sorted(options.items())).encode('utf-8'))
+    digest.update(raw)
+    return digest.hexdigest()
+
+
+def correlate(mats, concatenate=False, fisher=False):
+    """ Compute ROI x ROI correlations for one or more runs.
+
+    Runs are z-scored so that a correlation matrix reduces to a single matrix
+    product. Runs of equal length are stacked and handled by one batched
+    matmul call rather than one call per run.
+
+    Arguments:
+        mats - A list of ROI x time arrays
+        concatenate - If True, z-score each run then concatenate them in time and return one matrix
+        fisher - If True, Fisher z-transform (arctanh) the correlations
+
+    Returns:
+        An array of shape (runs, ROI, ROI), or (1, ROI, ROI) if concatenate is set
+    """
+    if concatenate:
+        zs = np.concatenate([zscore(mat) for mat in mats], axis=-1)[np.newaxis]
+    elif len(set(mat.shape for mat in mats)) == 1:
+        zs = zscore(np.stack(mats))
+    else:
+        # Unequal run lengths can't be stacked, fall back to one product per run
+        return np.stack([correlate([mat], fisher=fisher)[0] for mat in mats])
+
+    corr = np.matmul(zs, zs.transpose(0, 2, 1)) / zs.shape[-1]
+
+    if fisher:
+        # Clip so that (near) perfect correlations don't become infinite
+        corr = np.arctanh(np.clip(corr, -1 + 1e-7, 1 - 1e-7))
+
+    return corr
+
+
+def upper_triangle(corr):
+    """ Compact a (..., ROI, ROI) array to its float32 upper triangle, diagonal excluded. """
+    rows, cols = np.triu_indices(corr.shape[-1], k=1)
+    return corr[..., rows, cols].astype(np.float32)
+
+
+def to_matrix(record, run=None):
+    """ Expand a stored connectivity record back to a square ROI x ROI matrix.
+
+    Arguments:
+        record - A dictionary as returned by subject_connectivity()
+        run - The run to expand, may be omitted if the record holds a single matrix
+
+    Returns:
+        A ROI x ROI float32 array. The diagonal is 1 (or 0 for Fisher-z records where arctanh(1) is undefined)
+    """
+    if run is None:
+        if len(record['runs']) != 1:
+            raise KeyError('Record holds several runs, specify one of: %s' % ', '.join(record['runs']))
+        idx = 0
+    else:
+        idx = record['runs'].index(run)
+
+    n = len(record['rois'])
+    mat = np.zeros((n, n), dtype=np.float32)
+    rows, cols = np.triu_indices(n, k=1)
+    mat[rows, cols] = record['edges'][idx]
+    mat[cols, rows] = record['edges'][idx]
+    if not record['fisher']:
+        np.fill_diagonal(mat, 1.0)
+
+    return mat
+
+
+def subject_connectivity(subject, concatenate=False, fisher=False, cached=None):
+    """ Derive the functional connectivity of a single subject.
+
+    Arguments:
+        subject - A dictionary as returned by clean_subject()
+        concatenate - If True, compute one matrix over all runs concatenated in time
+        fisher - If True, store Fisher z-transformed correlations
+        cached - A previously returned record, reused as is if its hash matches the data
+
+    Returns:
+        A dictionary with keys 'hash', 'rois', 'runs', 'concatenate', 'fisher' and 'edges', where
+        'edges' is a (runs, ROI*(ROI-1)/2) float32 array of upper triangles. When concatenate is set
+        'runs' is the single entry 'ALL'.
+    """
+    rois, runs, mats = stack_runs(subject)
+    digest = content_hash(rois, runs, mats, concatenate=concatenate, fisher=fisher)
+
+    if cached is not None and cached.get('hash') == digest:
+        return cached
+
+    return {'hash': digest,
+            'rois': rois,
+            'runs': ['ALL'] if concatenate else runs,
+            'concatenate': concatenate,
+            'fisher': fisher,
+            'edges': upper_triangle(correlate(mats, concatenate, fisher))}
+
+
+def derive_shelf(fname, fout=None, concatenate=False, fisher=False):
+    """ Derive connectivity for every subject in a shelf produced by automate.py.
+
+    Records are written to a separate shelf keyed by subject id, with a 'source' hash of
+    the subject's stored bytes. Subjects whose record has a matching 'source' are skipped
+    without being loaded from the input shelf.
+
+    Arguments:
+        fname - The input shelf, e.g. 'HCP_1200/hcp_data_0.gdb'
+        fout - The output shelf, defaults to fname with '_fc' appended to the stem
+        concatenate, fisher - See subject_connectivity()
+
+    Returns:
+        The output shelf file name
+    """
+    if fout is None:
+        stem, ext = os.path.splitext(fname)
+        fout = stem + '_fc' + (ext or '.gdb')
+
+    with zipshelve.open(fname, 'r') as shelf, \
+            zipshelve.open(fout, protocol=HIGHEST_PROTOCOL) as out:
+        for key in shelf.keys():
+            raw = shelf.dict[key.encode(shelf.keyencoding)]
+            source = source_hash(raw, concatenate=concatenate, fisher=fisher)
+            cached = out[key] if key in out else None
+            if cached is not None and cached.get('source') == source:
+                continue
+
+            subject = shelf[key]
+            if not isinstance(subject, dict):
+                # clean_subject() returns False for subjects it failed on
+                continue
+            record = subject_connectivity(subject, concatenate, fisher, cached)
+            out[key] = dict(record, source=source)
+
+    return fout
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Derive functional connectivity for existing shelves')
+    parser.add_argument('shelves', nargs='+', help='shelves written by automate.py')
+    parser.add_argument('--concatenate', action='store_true', help='one matrix over all runs concatenated in time')
+    parser.add_argument('--fisher', action='store_true', help='store Fisher z-transformed correlations')
+    args = parser.parse_args()
+
+    for fname in args.shelves:
+        print('Derived connectivity: \t', derive_shelf(fname, concatenate=args.concatenate, fisher=args.fisher))
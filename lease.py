@@ -0,0 +1,246 @@
+import os
+import socket
+import threading
+import uuid
+
+# Coordinator-free work leasing on a shared filesystem. Every worker (on any
+# host) walks the same subject list and claims a subject by atomically creating
+# '<lease_dir>/<subject>.lease'. While a subject is being processed the owner
+# keeps touching the lease file; a lease that hasn't been touched for `ttl`
+# seconds is considered abandoned by a dead worker and may be reclaimed. Lease
+# age is measured against the shared filesystem's clock (by touching a probe
+# file), not the local one, so hosts with skewed clocks agree on it. A finished
+# subject gets a '<subject>.done' marker and is skipped from then on. Every
+# time processing a subject raises, a line is added to '<subject>.attempts' and
+# the subject is released for another try; after `attempts` tries it gets a
+# '<subject>.failed' marker and is skipped as well (delete both to retry it).
+#
+# A worker that stalls past `ttl` can lose its lease while still running. It
+# notices this before storing its result (see Lease.lost) and drops the result,
+# so a subject is stored by whichever worker holds its lease at the end.
+
+ttl = 300
+attempts = 3
+
+
+def worker_id():
+    """ A name for this process that is unique across hosts, used for leases and shard names. """
+    return '%s_%d' % (socket.gethostname(), os.getpid())
+
+
+def _lease_path(lease_dir, sid):
+    return os.path.join(lease_dir, sid + '.lease')
+
+
+def _done_path(lease_dir, sid):
+    return os.path.join(lease_dir, sid + '.done')
+
+
+def _failed_path(lease_dir, sid):
+    return os.path.join(lease_dir, sid + '.failed')
+
+
+def _attempts_path(lease_dir, sid):
+    return os.path.join(lease_dir, sid + '.attempts')
+
+
+def _finished(lease_dir, sid):
+    return os.path.exists(_done_path(lease_dir, sid)) or os.path.exists(_failed_path(lease_dir, sid))
+
+
+def _create(path, token):
+    """ Atomically create path containing token, returns False if it already exists. """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as stream:
+        stream.write(token)
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as stream:
+            return stream.read()
+    except FileNotFoundError:
+        return None
+
+
+def _fs_now(lease_dir):
+    """ The current time according to the filesystem holding lease_dir (e.g. the NFS server). """
+    probe = os.path.join(lease_dir, '.clock.%s' % uuid.uuid4().hex)
+    _create(probe, '')
+    try:
+        return os.stat(probe).st_mtime
+    finally:
+        os.unlink(probe)
+
+
+def _is_stale(path, ttl, now):
+    try:
+        return now - os.stat(path).st_mtime > ttl
+    except FileNotFoundError:
+        return False
+
+
+def _break_stale(path, ttl):
+    """ Remove an expired lease, making sure not to remove a fresh one claimed in the meantime.
+
+    The lease is first renamed to a unique name, which only one of several competing workers can
+    succeed at. If the lease we moved aside is not the one we found stale (its token changed, or it
+    was refreshed), another worker broke and reclaimed it between our check and the rename, so it is
+    linked back in place. Should a third worker have claimed the path in that short window, the
+    moved lease is lost; its owner finds out on its next heartbeat and drops its result.
+    """
+    now = _fs_now(os.path.dirname(path))
+    token = _read(path)
+    if token is None or not _is_stale(path, ttl, now):
+        return
+
+    aside = '%s.%s.stale' % (path, uuid.uuid4().hex)
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return
+
+    if _read(aside) != token or not _is_stale(aside, ttl, now):
+        try:
+            os.link(aside, path)
+        except FileExistsError:
+            pass
+
+    os.unlink(aside)
+
+
+class Lease(object):
+    """
+    A claim on a single subject, kept alive by a heartbeat thread while in use as a context manager
+    """
+
+    def __init__(self, lease_dir, sid, token, ttl=ttl):
+        self.lease_dir = lease_dir
+        self.sid = sid
+        self.token = token
+        self.ttl = ttl
+        self.lost = False
+        self.__path = _lease_path(lease_dir, sid)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def owned(self):
+        """ True if the lease file on disk still belongs to us. """
+        return _read(self.__path) == self.token
+
+    def heartbeat(self):
+        """ Refresh the lease, returns False (and sets lost) if it was taken over. """
+        if not self.owned():
+            self.lost = True
+            return False
+        try:
+            os.utime(self.__path)
+        except FileNotFoundError:
+            self.lost = True
+            return False
+        return True
+
+    def __beat(self):
+        while not self.__stop.wait(self.ttl / 3.0):
+            if not self.heartbeat():
+                return
+
+    def done(self):
+        """ Mark the subject finished and release the lease. """
+        _create(_done_path(self.lease_dir, self.sid), self.token)
+        self.release()
+
+    def fail(self, error, max_attempts=attempts):
+        """ Record a failed attempt and release the lease so the subject can be retried.
+
+        After max_attempts failed attempts the subject is marked failed, so that no worker picks
+        it up again. Nothing is recorded if the lease was taken over in the meantime.
+
+        Returns:
+            False (and sets lost) if the lease was no longer ours, True otherwise
+        """
+        if not self.owned():
+            self.lost = True
+            return False
+
+        with open(_attempts_path(self.lease_dir, self.sid), 'a') as stream:
+            stream.write('%s\t%r\n' % (self.token, error))
+        with open(_attempts_path(self.lease_dir, self.sid)) as stream:
+            tries = len(stream.readlines())
+
+        if tries >= max_attempts:
+            _create(_failed_path(self.lease_dir, self.sid), '%s\n%r\n' % (self.token, error))
+        self.release()
+        return True
+
+    def release(self):
+        """ Give up the lease without marking the subject finished. """
+        if self.owned():
+            try:
+                os.unlink(self.__path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__beat, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.__stop.set()
+        self.__thread.join()
+
+
+def claim(lease_dir, sid, owner, ttl=ttl):
+    """ Try to claim a single subject.
+
+    Arguments:
+        lease_dir - Directory on the shared filesystem holding lease and done files
+        sid - The subject id
+        owner - Name of the claiming worker, see worker_id()
+        ttl - Seconds without a heartbeat after which a lease counts as abandoned
+
+    Returns:
+        A Lease, or None if the subject is done, failed or held by a live worker
+    """
+    if _finished(lease_dir, sid):
+        return None
+
+    path = _lease_path(lease_dir, sid)
+    token = '%s %s' % (owner, uuid.uuid4().hex)
+
+    if not _create(path, token):
+        _break_stale(path, ttl)
+        if not _create(path, token):
+            return None
+
+    # The subject may have been finished between the check above and our claim
+    if _finished(lease_dir, sid):
+        os.unlink(path)
+        return None
+
+    return Lease(lease_dir, sid, token, ttl)
+
+
+def claim_next(lease_dir, subject_ids, owner, ttl=ttl):
+    """ Claim the first subject in subject_ids that is not done, failed or held by a live worker.
+
+    Returns:
+        A Lease, or None if there is nothing left to claim
+    """
+    os.makedirs(lease_dir, exist_ok=True)
+    for sid in subject_ids:
+        lease = claim(lease_dir, sid, owner, ttl)
+        if lease is not None:
+            return lease
+    return None
+
+
+def remaining(lease_dir, subject_ids):
+    """ Subjects without a done or failed marker (claimed or not). """
+    return [sid for sid in subject_ids if not _finished(lease_dir, sid)]
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import connectivity
+import zipshelve
+
+rng = np.random.default_rng(0)
+rois = ['ROI_%d' % i for i in range(6)]
+
+
+def make_subject(lengths=(80, 80)):
+    runs = ['REST%d_LR' % (i + 1) for i in range(len(lengths))]
+    subject = {run: {roi: rng.standard_normal(n) for roi in rois} for run, n in zip(runs, lengths)}
+    subject['metadata'] = 'meta'
+    return subject
+
+
+def test_runs_match_corrcoef():
+    subject = make_subject()
+    record = connectivity.subject_connectivity(subject)
+    assert record['runs'] == ['REST1_LR', 'REST2_LR']
+    assert record['edges'].dtype == np.float32
+    assert record['edges'].shape == (2, len(rois) * (len(rois) - 1) // 2)
+
+    for run in record['runs']:
+        expected = np.corrcoef([subject[run][roi] for roi in rois])
+        assert np.allclose(connectivity.to_matrix(record, run), expected, atol=1e-6)
+
+
+def test_concatenate_and_fisher():
+    subject = make_subject()
+    record = connectivity.subject_connectivity(subject, concatenate=True, fisher=True)
+    assert record['runs'] == ['ALL']
+
+    def zscore(x):
+        return (x - x.mean()) / x.std()
+
+    joined = [np.concatenate([zscore(subject[run][roi]) for run in ('REST1_LR', 'REST2_LR')]) for roi in rois]
+    expected = np.corrcoef(joined)
+    np.fill_diagonal(expected, 0)
+    expected = np.arctanh(expected)
+    assert np.allclose(connectivity.to_matrix(record), expected, atol=1e-5)
+
+
+def test_unequal_run_lengths():
+    subject = make_subject(lengths=(80, 50))
+    record = connectivity.subject_connectivity(subject)
+    for run in record['runs']:
+        expected = np.corrcoef([subject[run][roi] for roi in rois])
+        assert np.allclose(connectivity.to_matrix(record, run), expected, atol=1e-6)
+
+
+def test_cache_returns_record():
+    subject = make_subject()
+    record = connectivity.subject_connectivity(subject)
+    assert connectivity.subject_connectivity(subject, cached=record) is record
+    assert connectivity.subject_connectivity(subject, fisher=True, cached=record) is not record
+
+
+def test_derive_shelf(tmp_path):
+    fname = os.path.join(str(tmp_path), 'hcp_data_0.gdb')
+    with zipshelve.open(fname) as shelf:
+        shelf['100206'] = make_subject()
+        shelf['100307'] = False
+
+    fout = connectivity.derive_shelf(fname)
+    assert fout == os.path.join(str(tmp_path), 'hcp_data_0_fc.gdb')
+    with zipshelve.open(fout, 'r') as out:
+        assert list(out.keys()) == ['100206']
+        first = out['100206']
+
+    # Up-to-date records are left as they are, changed options are recomputed
+    connectivity.derive_shelf(fname)
+    with zipshelve.open(fout, 'r') as out:
+        assert out['100206']['source'] == first['source']
+    connectivity.derive_shelf(fname, fisher=True)
+    with zipshelve.open(fout, 'r') as out:
+        assert out['100206']['fisher'] and out['100206']['source'] != first['source']
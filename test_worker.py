@@ -0,0 +1,87 @@
+import os
+import functools
+import multiprocessing as mp
+import pytest
+import automate
+import lease
+import zipshelve
+
+# Several worker processes sharing one lease directory, with a stand-in for
+# do_subject() so that neither R, AWS nor workbench is needed. One worker dies
+# while holding a lease, one subject always fails and one fails only once.
+
+subject_ids = [str(i) for i in range(30)]
+
+
+def fake_subject(tmp, sid):
+    if sid == '5' and lease._create(os.path.join(tmp, 'died'), ''):
+        # The first worker to get here dies holding the lease
+        os._exit(1)
+    if sid == '7':
+        raise KeyError(sid)
+    if sid == '9' and lease._create(os.path.join(tmp, 'flaky'), ''):
+        raise IOError('transient error')
+    return 'processed ' + sid
+
+
+def run_worker(tmp):
+    automate.worker(lease_dir=os.path.join(tmp, 'leases'), fin=os.path.join(tmp, 'hcp_data_'),
+                    subject_ids=subject_ids, process=functools.partial(fake_subject, tmp), ttl=1.0)
+
+
+@pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='needs fork')
+def test_workers_share_subjects(tmp_path):
+    tmp = str(tmp_path)
+    ctx = mp.get_context('fork')
+    procs = [ctx.Process(target=run_worker, args=(tmp,)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(60)
+
+    assert sorted(proc.exitcode for proc in procs) == [0, 0, 0, 1]
+
+    shards = {name.split('.gdb')[0] + '.gdb' for name in os.listdir(tmp) if name.startswith('hcp_data_')}
+    stored = list()
+    for shard in shards:
+        with zipshelve.open(os.path.join(tmp, shard), 'r') as shelf:
+            stored.extend((key, shelf[key]) for key in shelf.keys())
+
+    keys = [key for key, _ in stored]
+    assert len(keys) == len(set(keys))
+    assert sorted(keys) == sorted(sid for sid in subject_ids if sid != '7')
+    assert all(value == 'processed ' + key for key, value in stored)
+
+    leases = os.listdir(os.path.join(tmp, 'leases'))
+    assert '7.failed' in leases and '9.failed' not in leases
+    with open(os.path.join(tmp, 'leases', '7.attempts')) as stream:
+        assert len(stream.readlines()) == lease.attempts
+    with open(os.path.join(tmp, 'leases', '9.attempts')) as stream:
+        assert len(stream.readlines()) == 1
+    assert not [name for name in leases if name.endswith(('.lease', '.stale')) or name.startswith('.clock')]
+    assert lease.remaining(os.path.join(tmp, 'leases'), subject_ids) == []
+
+
+def test_fail_on_lost_lease(tmp_path):
+    lease_dir = str(tmp_path)
+    claimed = lease.claim(lease_dir, '100206', 'a')
+    with open(os.path.join(lease_dir, '100206.lease'), 'w') as stream:
+        stream.write('b reclaimed')
+
+    assert not claimed.fail(KeyError('100206'))
+    assert claimed.lost
+    assert sorted(os.listdir(lease_dir)) == ['100206.lease']
+
+
+def test_stale_lease_is_reclaimed(tmp_path):
+    lease_dir = str(tmp_path)
+    assert lease.claim(lease_dir, '100206', 'a', ttl=60) is not None
+    assert lease.claim(lease_dir, '100206', 'b', ttl=60) is None
+
+    # Age the lease by the filesystem's clock rather than waiting for it
+    path = os.path.join(lease_dir, '100206.lease')
+    old = os.stat(path).st_mtime - 120
+    os.utime(path, (old, old))
+
+    claimed = lease.claim(lease_dir, '100206', 'b', ttl=60)
+    assert claimed is not None and claimed.owned()
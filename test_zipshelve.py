@@ -0,0 +1,104 @@
+import os
+import gzip
+import zlib
+import pickle
+import pytest
+import zipshelve
+from zipshelve import ZipArchive
+
+
+def make_archive(fname):
+    with zipshelve.open(fname) as shelf:
+        for i in range(20):
+            shelf[str(i)] = {'x': list(range(i))}
+
+
+def append_raw(fname, key, value):
+    """ Append a value record without writing a new index, as a writer that died would. """
+    data = zlib.compress(pickle.dumps(value))
+    with open(fname, 'ab') as stream:
+        stream.write(ZipArchive._record.pack(ZipArchive.VALUE, len(key), len(data)) + key + data)
+
+
+def test_round_trip(tmp_path):
+    fname = str(tmp_path / 'x.gz')
+    make_archive(fname)
+
+    with zipshelve.open(fname) as shelf:
+        shelf['3'] = 'new'
+        del shelf['0']
+        assert shelf['3'] == 'new'
+
+    with zipshelve.open(fname, 'r') as shelf:
+        assert len(shelf) == 19
+        assert '0' not in shelf
+        assert shelf['3'] == 'new'
+        assert shelf['12'] == {'x': list(range(12))}
+        with pytest.raises(IOError):
+            shelf['20'] = 1
+
+
+def test_reopen_without_close_scans(tmp_path):
+    fname = str(tmp_path / 'x.gz')
+    make_archive(fname)
+    append_raw(fname, b'20', 'unindexed')
+
+    with zipshelve.open(fname, 'r') as shelf:
+        assert len(shelf) == 21
+        assert shelf['20'] == 'unindexed'
+        assert shelf['5'] == {'x': list(range(5))}
+
+
+def test_truncated_record(tmp_path):
+    fname = str(tmp_path / 'x.gz')
+    make_archive(fname)
+    append_raw(fname, b'20', 'unindexed')
+    with open(fname, 'ab') as stream:
+        stream.write(b'\x00\x05')
+    size = os.path.getsize(fname)
+
+    # kept as is when reading
+    with zipshelve.open(fname, 'r') as shelf:
+        assert shelf['20'] == 'unindexed'
+    assert os.path.getsize(fname) == size
+
+    # dropped before appending when writing
+    with zipshelve.open(fname, 'c') as shelf:
+        shelf['21'] = 'appended'
+    with zipshelve.open(fname, 'r') as shelf:
+        assert len(shelf) == 22
+        assert shelf['20'] == 'unindexed' and shelf['21'] == 'appended'
+
+
+def test_damaged_index_scans(tmp_path):
+    fname = str(tmp_path / 'x.gz')
+    make_archive(fname)
+
+    # flip a byte in the middle of the compressed index
+    with open(fname, 'r+b') as stream:
+        stream.seek(-ZipArchive._trailer.size - 10, os.SEEK_END)
+        byte = stream.read(1)
+        stream.seek(-1, os.SEEK_CUR)
+        stream.write(bytes([byte[0] ^ 0xff]))
+
+    with zipshelve.open(fname, 'r') as shelf:
+        assert len(shelf) == 20
+        assert shelf['19'] == {'x': list(range(19))}
+
+
+def test_rejects_non_archives(tmp_path):
+    gz = str(tmp_path / 'old.gz')
+    with gzip.open(gz, 'wb') as stream:
+        stream.write(b'not an archive')
+    empty = str(tmp_path / 'empty.gz')
+    open(empty, 'wb').close()
+
+    for fname in (gz, empty):
+        with pytest.raises(TypeError):
+            zipshelve.open(fname, 'r')
+
+    # an empty file is initialised when writing
+    with zipshelve.open(empty, 'c') as shelf:
+        shelf['a'] = 1
+    with zipshelve.open(empty, 'r') as shelf:
+        assert shelf['a'] == 1
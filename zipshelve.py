@@ -10,9 +10,10 @@ compression of content
 
 However it contains several new features:
 
- - Optionally it is possible to perform the compression
-   of the whole data base, that can be rather useful for data base
-   with large amount of keys
+ - Optionally (for file names ending in ``.gz'') the whole data base
+   is kept in a single append-only archive file with a trailing key
+   index, see ZipArchive. The archive is read in place through mmap,
+   so looking up one key does not require decompressing the others
 """
 # =============================================================================
 __author__ = "Vanya BELYAEV Ivan.Belyaev@itep.ru"
@@ -20,7 +21,7 @@ __date__ = "2010-04-30"
 __version__ = "$Revision$"
 # =============================================================================
 
-__all__ = ('ZipShelf', 'open', 'tmpdb')
+__all__ = ('ZipShelf', 'ZipArchive', 'open', 'tmpdb')
 
 try:
     from cPickle import Pickler, Unpickler, HIGHEST_PROTOCOL
@@ -29,9 +30,12 @@ except ImportError:
 
 # ==============================================================================
 import os
+import io
 import zlib  # use zlib to compress DB-content
+import mmap
+import struct
 import shelve
-import shutil
+import pickle
 from io import BytesIO
 import errno
 import logging as logger
@@ -52,9 +56,7 @@ class ZipShelf(shelve.Shelf):
         filename = os.path.expandvars(filename)
         filename = os.path.expandvars(filename)
 
-        self.__gzip = False
         self.__filename = filename
-        self.__remove = False
         self.__silent = silent
         self.__opened = False
 
@@ -62,49 +64,16 @@ class ZipShelf(shelve.Shelf):
             logger.info('Open DB: %s' % filename)
 
         if filename.rfind('.gz') + 3 == len(filename):
+            # whole data base in a single archive file
+            dict_ = ZipArchive(filename, mode)
 
-            if os.path.exists(filename) and mode == 'r':
-                # gunzip into temporary location
-                filename_ = self._gunzip(filename)
-
-                if not os.path.exists(filename_):
-                    raise TypeError("Unable to gunzip properly: %s" % filename)
-
-                if not self.__silent:
-                    size1 = os.path.getsize(filename)
-                    size2 = os.path.getsize(filename_)
-                    logger.info("GZIP uncompression %s: %.1f%%" % (filename, (size2 * 100.0) / size1))
-
-                self.__filename = filename_
-                self.__remove = True
-            elif os.path.exists(filename) and mode != 'r':
-                filename_ = filename[:-3]
-
-                # remove existing file (if needed)
-                if os.path.exists(filename_):
-                    os.remove(filename_)
-                size1 = os.path.getsize(filename)
-
-                # gunzip in place
-                self.__in_place_gunzip(filename)
-
-                if not os.path.exists(filename_):
-                    raise TypeError("Unable to gunzip properly: %s" % filename)
-
-                if not self.__silent:
-                    size2 = os.path.getsize(filename_)
-                    logger.info("GZIP uncompression %s: %.1f%%" % (filename, (size2 * 100.0) / size1))
-
-                self.__gzip = True
-                self.__filename = filename_
-                self.__remove = False
-            else:
-                filename = filename[:-3]
-                self.__gzip = True
-                self.__filename = filename
+            if not self.__silent:
+                logger.info('Archive %s: %d keys, %d bytes' % (filename, len(dict_), os.path.getsize(filename)))
+        else:
+            import dbm
+            dict_ = dbm.open(filename, mode)
 
-        import dbm
-        shelve.Shelf.__init__(self, dbm.open(self.__filename, mode), protocol, writeback)
+        shelve.Shelf.__init__(self, dict_, protocol, writeback)
         self.compress_level = compress
         self.__opened = True
 
@@ -142,10 +111,10 @@ class ZipShelf(shelve.Shelf):
         """
         return self.__dir(pattern)
 
-    # close and gzip (if needed)
+    # close the file
     def close(self):
         """
-        Close the file (and gzip it if required) 
+        Close the file (writing the key index for archives)
         """
         if not self.__opened:
             return
@@ -153,119 +122,202 @@ class ZipShelf(shelve.Shelf):
         shelve.Shelf.close(self)
         self.__opened = False
 
-        if self.__remove and os.path.exists(self.__filename):
-            if not self.__silent:
-                logger.info('REMOVING: ', self.__filename)
-            os.remove(self.__filename)
+    # some context manager functionality
+    def __enter__(self):
+        return self
 
-        if self.__gzip and os.path.exists(self.__filename):
-            # get the initial size 
-            size1 = os.path.getsize(self.__filename)
+    def __exit__(self, *_):
+        self.close()
 
-            # gzip the file
-            self.__in_place_gzip(self.__filename)
-            
-            if not os.path.exists(self.__filename + '.gz'):
-                logger.warning('Unable to compress the file %s ' % self.__filename)
-            size2 = os.path.getsize(self.__filename + '.gz')
 
-            if not self.__silent:
-                logger.info('GZIP compression %s: %.1f%%' % (self.__filename, (size2 * 100.0) / size1))
+# =============================================================================
+# Single-file archive used by ZipShelf for ``.gz'' data bases
+class ZipArchive(object):
+    """
+    Append-only, single-file archive with a trailing key index. 
 
-    # gzip the file (``in-place'')
-    def __in_place_gzip(self, filein):
-        """
-        Gzip the file ``in-place''
-        
-        It is better to use here ``os.system'' or ``popen''-family,
-        but it does not work properly for multiprocessing environment
-        
-        """
-        if os.path.exists(filein + '.gz'):
-            os.remove(filein + '.gz')
-        
-        # gzip the file 
-        fileout = self._gzip(filein)
-         
-        if os.path.exists(fileout):
-            # rename the temporary file 
-            safe_move(fileout, filein + '.gz')
-
-            # remove the original
-            os.remove(filein)
-
-    # gunzip the file (``in-place'')
-    def __in_place_gunzip(self, filein):
-        """
-        Gunzip the file ``in-place''
-        
-        It is better to use here ``os.system'' or ``popen''-family,
-        but unfortunately it does not work properly for multi-threaded environment
-        
-        """
-        filename = filein[:-3]
-        if os.path.exists(filename):
-            os.remove(filename)
-
-        # gunzip the file 
-        fileout = self._gunzip(filein)
-                
-        if os.path.exists(fileout):
-            # rename the temporary file 
-            safe_move(fileout, filename)
-            
-            # remove the original
-            os.remove(filein)
-
-    # gzip the file into temporary location, keep original
-    def _gzip(self, filein):
-        """
-        Gzip the file into temporary location, keep original
-        """
-        if not os.path.exists(filein):
-            raise NameError("GZIP: non existing file: " + filein)
-
-        import tempfile, gzip
-
-        with file(filein, 'r') as fin:
-            fd, fileout = tempfile.mkstemp(prefix='tmp_', suffix='_zdb.gz')
-            with gzip.open(fileout, 'w') as fout:
-                try:
-                    for f in fin:
-                        fout.write(f)
-                except Exception as e:
-                    logger.error(e)
-        
-        return fileout
-
-    # gunzip the file into temporary location, keep original
-    def _gunzip(self, filein):
-        """
-        Gunzip the file into temporary location, keep original
-        """
-        if not os.path.exists(filein):
-            raise NameError("GUNZIP: non existing file: " + filein)
+    It plays the role of the ``dbm''-object underneath ZipShelf: keys and
+    values are bytes, and values arrive already zlib-compressed, so every
+    record is an independently compressed block. The layout is
 
-        import gzip, tempfile
+        MAGIC | record | record | ... | index record | trailer
 
-        with gzip.open(fielin, 'r') as fin:
-            fd, fileout = tempfile.mkstemp(prefix='tmp_', suffix='_zdb')
-            with file(fileout, 'w') as fout:
-                try:
-                    for f in fin:
-                        fout.write(f)
-                except Exception as e:
-                    logger.error(e)
+    where each record is a ``(kind, key length, value length)'' header
+    followed by the key and the value. Kinds are VALUE, DELETE and INDEX.
+    The index record holds the compressed ``key -> (offset, length)''
+    mapping and the trailer holds the offset of the index record.
 
-        return fileout
+    Opening an archive reads only the trailer and the index; values are
+    sliced out of an mmap of the file on demand. Writes never modify
+    existing bytes: new records are appended and a new index is appended
+    on ``sync''/``close''. If the trailer is missing (e.g. the writer
+    died before closing) the index is rebuilt by scanning the records.
 
+    Only one process may write to an archive at a time.
+    """
 
-    # some context manager functionality
-    def __enter__(self):
-        return self
+    MAGIC = b'ZIPSHELF'
+    VALUE, DELETE, INDEX = 0, 1, 2
 
-    def __exit__(self, *_):
-        self.close()
+    _record = struct.Struct('<BII')
+    _trailer = struct.Struct('<Q8s')
+
+    def __init__(self, filename, mode='c'):
+
+        if mode not in ('r', 'w', 'c', 'n'):
+            raise ValueError("Flag must be one of 'r', 'w', 'c', or 'n'")
+
+        exists = os.path.exists(filename)
+        if not exists and mode in ('r', 'w'):
+            raise IOError(errno.ENOENT, 'No such archive', filename)
+
+        # an empty file (e.g. from tempfile.mkstemp) is treated like a new one
+        if mode == 'n' or (mode != 'r' and (not exists or os.path.getsize(filename) == 0)):
+            with io.open(filename, 'wb') as stream:
+                stream.write(self.MAGIC)
+
+        self.__filename = filename
+        self.__readonly = mode == 'r'
+        self.__dirty = False
+        self.__file = io.open(filename, 'rb' if self.__readonly else 'r+b')
+
+        # can't mmap an empty file, which isn't an archive anyway
+        is_archive = self.__file.read(len(self.MAGIC)) == self.MAGIC
+        if not is_archive:
+            self.__file.close()
+            raise TypeError('Not a ZipShelf archive: %s' % filename)
+
+        self.__map()
+        self.__index = self.__read_index()
+        if self.__index is None:
+            self.__index = self.__scan()
+
+    def __map(self):
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # read the index pointed to by the trailer
+    def __read_index(self):
+        size = len(self.__mm)
+        if size < len(self.MAGIC) + self._trailer.size:
+            return None
+
+        offset, magic = self._trailer.unpack_from(self.__mm, size - self._trailer.size)
+        if magic != self.MAGIC or offset + self._record.size > size:
+            return None
+
+        kind, klen, vlen = self._record.unpack_from(self.__mm, offset)
+        start = offset + self._record.size + klen
+        if kind != self.INDEX or start + vlen + self._trailer.size != size:
+            return None
+
+        try:
+            return pickle.loads(zlib.decompress(self.__mm[start:start + vlen]))
+        except (zlib.error, pickle.UnpicklingError, EOFError):
+            # damaged index, the records can still be scanned
+            return None
+
+    # rebuild the index by walking over all records
+    def __scan(self):
+        size = len(self.__mm)
+        index = dict()
+        pos = len(self.MAGIC)
+
+        while pos + self._record.size <= size:
+            kind, klen, vlen = self._record.unpack_from(self.__mm, pos)
+            start = pos + self._record.size
+            end = start + klen + vlen
+            if kind == self.INDEX:
+                end += self._trailer.size
+            if end > size or kind not in (self.VALUE, self.DELETE, self.INDEX):
+                break
+
+            key = self.__mm[start:start + klen]
+            if kind == self.VALUE:
+                index[key] = (start + klen, vlen)
+            elif kind == self.DELETE:
+                index.pop(key, None)
+            pos = end
+
+        if pos != size:
+            logger.warning('Archive %s is truncated, recovered %d keys' % (self.__filename, len(index)))
+            if not self.__readonly:
+                # drop the partial record so new ones can be appended after it
+                self.__mm.close()
+                self.__file.truncate(pos)
+                self.__map()
+
+        return index
+
+    # append a single record, returns the offset of its value
+    def __append(self, kind, key, value):
+        if self.__readonly:
+            raise IOError('Archive opened read-only: %s' % self.__filename)
+
+        self.__file.seek(0, io.SEEK_END)
+        offset = self.__file.tell()
+        self.__file.write(self._record.pack(kind, len(key), len(value)))
+        self.__file.write(key)
+        self.__file.write(value)
+        self.__dirty = True
+        return offset
+
+    @staticmethod
+    def __key(key):
+        return key.encode('utf-8') if isinstance(key, str) else bytes(key)
+
+    def __getitem__(self, key):
+        offset, length = self.__index[self.__key(key)]
+        if offset + length > len(self.__mm):
+            # appended after the file was mapped
+            self.__file.flush()
+            self.__mm.close()
+            self.__map()
+        return self.__mm[offset:offset + length]
+
+    def __setitem__(self, key, value):
+        key = self.__key(key)
+        offset = self.__append(self.VALUE, key, value)
+        self.__index[key] = (offset + self._record.size + len(key), len(value))
+
+    def __delitem__(self, key):
+        key = self.__key(key)
+        if key not in self.__index:
+            raise KeyError(key)
+        self.__append(self.DELETE, key, b'')
+        del self.__index[key]
+
+    def __contains__(self, key):
+        return self.__key(key) in self.__index
+
+    def __iter__(self):
+        return iter(list(self.__index))
+
+    def __len__(self):
+        return len(self.__index)
+
+    def keys(self):
+        return list(self.__index)
+
+    def sync(self):
+        """
+        Append the key index and trailer, so that the archive can be opened without a scan
+        """
+        if self.__readonly or not self.__dirty:
+            return
+
+        data = zlib.compress(pickle.dumps(self.__index, HIGHEST_PROTOCOL))
+        offset = self.__append(self.INDEX, b'', data)
+        self.__file.write(self._trailer.pack(offset, self.MAGIC))
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__dirty = False
+
+    def close(self):
+        if self.__file.closed:
+            return
+        self.sync()
+        self.__mm.close()
+        self.__file.close()
 
 
 # =============================================================================
@@ -302,45 +354,6 @@ ZipShelf.__getitem__ = _zip_getitem
 ZipShelf.__setitem__ = _zip_setitem
 
 
-# =============================================================================
-# helper function to access ZipShelve data base
-def safe_move(src, dst):
-    """Rename a file from ``src`` to ``dst``.
-
-    *   Moves must be atomic.  ``shutil.move()`` is not atomic.
-        Note that multiple threads may try to write to the cache at once,
-        so atomicity is required to ensure the serving on one thread doesn't
-        pick up a partially saved image from another thread.
-
-    *   Moves must work across filesystems.  Often temp directories and the
-        cache directories live on different filesystems.  ``os.rename()`` can
-        throw errors if run across filesystems.
-
-    So we try ``os.rename()``, but if we detect a cross-filesystem copy, we
-    switch to ``shutil.move()`` with some wrappers to make it atomic.
-    """
-    try:
-        os.rename(src, dst)
-    except OSError as err:
-
-        if err.errno == errno.EXDEV:
-            # Generate a unique ID, and copy `<src>` to the target directory
-            # with a temporary name `<dst>.<ID>.tmp`.  Because we're copying
-            # across a filesystem boundary, this initial copy may not be
-            # atomic.  We intersperse a random UUID so if different processes
-            # are copying into `<dst>`, they don't overlap in their tmp copies.
-            copy_id = uuid.uuid4()
-            tmp_dst = "%s.%s.tmp" % (dst, copy_id)
-            shutil.copyfile(src, tmp_dst)
-
-            # Then do an atomic rename onto the new name, and clean up the
-            # source image.
-            os.rename(tmp_dst, dst)
-            os.unlink(src)
-        else:
-            raise
-
-
 def open(filename, mode='c', protocol=HIGHEST_PROTOCOL, compress_level=zlib.Z_BEST_COMPRESSION,
          writeback=False, silent=True):
     """